@@ -5,17 +5,74 @@ from dotenv import load_dotenv
 import os
 import sys
 from jira import JIRA
-from datetime import datetime, timedelta
 import sqlite3
 import hashlib
 import schedule
 import requests
+from requests.adapters import HTTPAdapter, Retry
 import logging
+import time
 
 load_dotenv()
 JIRA_TOKEN = os.getenv("JIRA_TOKEN")
 JIRA_EMAIL = os.getenv("JIRA_EMAIL")
 HEALTH_CHECK_URL = os.getenv("HEALTH_CHECK_URL")
+JIRA_SERVER = "https://quadram-institute.atlassian.net"
+JIRA_API_REQUEST_TIMEOUT = float(os.getenv("JIRA_API_REQUEST_TIMEOUT", 60))
+# The connection shared by scheduled runs, see get_connection()
+_CONN = None
+
+# Columns of the issues table, in the order each row is written
+COLUMNS = (
+    "assignee",
+    "assignee_id",
+    "created",
+    "creator",
+    "description",
+    "due_date",
+    "environment",
+    "issue_type",
+    "issue_key",
+    "issue_id",
+    "labels",
+    "last_viewed",
+    "priority",
+    "project",
+    "reporter",
+    "resolution",
+    "resolution_date",
+    "status",
+    "summary",
+    "updated",
+    "original_estimate",
+    "remaining_estimate",
+    "worklog",
+    "time_tracking",
+    "isp",
+    "md5_hash",
+)
+# Generated once at import and reused for every page of issues
+INSERT_SQL = f"""
+    INSERT INTO issues ({", ".join(COLUMNS)})
+    VALUES ({", ".join("?" * len(COLUMNS))})
+"""
+UPSERT_SQL = f"""
+    {INSERT_SQL.strip()}
+    ON CONFLICT (issue_key) DO UPDATE
+    SET {", ".join(f"{c} = excluded.{c}" for c in COLUMNS if c != "issue_key")}
+    WHERE issues.md5_hash <> excluded.md5_hash
+"""
+# Only used by the first load of an empty database, before the index is built
+UPDATE_SQL = f"""
+    UPDATE issues
+    SET {", ".join(f"{c} = ?" for c in COLUMNS)}
+    WHERE issue_key = ?
+"""
+# SQLite builds before 3.32 allow at most 999 bound variables per statement
+PROBE_CHUNK_SIZE = 900
+CREATE_INDEX_SQL = (
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_issues_issue_key ON issues (issue_key)"
+)
 
 
 # logging.basicConfig()
@@ -65,73 +122,58 @@ def valid_key(pattern, key):
     return key
 
 
-def calculate_md5(*args):
+def _readable(value):
     """
-    Calculates the MD5 hash of the given arguments.
+    Returns a readable form of a raw JIRA option field value, such as the ISP field.
 
     Args:
-        *args: Variable length arguments to be hashed.
+        value: The raw JSON value of the field.
 
     Returns:
-        str: The MD5 hash of the concatenated string representation of the arguments.
+        str: The option's ``value`` or ``name``, else ``str()`` of the raw value.
     """
-    m = hashlib.md5()
-    for arg in args:
-        if arg is not None:
-            m.update(str(arg).encode("utf-8"))
-    return m.hexdigest()
+    if isinstance(value, dict):
+        for name in ("value", "name"):
+            if name in value:
+                return str(value[name])
+    return str(value)
 
 
-def update(database_location, days, project, email, token, health_check_url=None):
+def calculate_hash(data):
     """
-    Updates the database with issues from JIRA based on the given parameters.
+    Calculates a BLAKE2b change-detection hash of a row of issue data.
 
     Args:
-        database_location (str): The location of the SQLite database.
-        days (int): The number of days from today to calculate the date.
-        project (str): The project key to filter the issues.
-        email (str): The JIRA email.
-        token (str): The JIRA token.
-
-    Raises:
-        ValueError: If the JIRA email or token is not provided.
+        data (tuple): The row values to be hashed.
 
     Returns:
-        None
-
+        str: The 128-bit hex digest of the row's repr, which depends only on its values.
     """
-    if email is None or token is None:
-        raise ValueError("Jira email and token are required")
-    jira = JIRA(
-        server="https://quadram-institute.atlassian.net",
-        basic_auth=(email, token),
-    )
-    logging.info(f"Health check: {HEALTH_CHECK_URL}")
-    # bsup = jira.project(project)
+    return hashlib.blake2b(
+        repr(data).encode("utf-8"), digest_size=16, usedforsecurity=False
+    ).hexdigest()
 
-    # Calculate the date n days from today
-    one_month_ago = datetime.now() - timedelta(days=days)
-    one_month_ago_str = one_month_ago.strftime("%Y-%m-%d")
 
-    # Define JQL query to fetch issues created or updated after one month ago
-    jql_query = f"createdDate >= '{one_month_ago_str}' AND updated >= '{one_month_ago_str}' AND project={project}"
-    # jql_query = f"project={project}"
-
-    # Define fields to retrieve
-    # fields = [
-    #     'summary', 'key', 'id', 'parent', 'issuetype', 'status',
-    #     'project', 'priority', 'resolution', 'assignee', 'reporter',
-    #     'creator', 'created', 'updated', 'lastViewed', 'resolved',
-    #     'duedate', 'votes', 'labels', 'description', 'environment'
-    # ]
+def connect_database(database_location):
+    """
+    Opens the SQLite database and creates the issues table if needed.
 
-    max_results = 100
-    start_at = 0
-    logging.info("Starting...")
+    Args:
+        database_location (str): The location of the SQLite database.
 
-    # Create a SQLite database connection
-    conn = sqlite3.connect(database_location)
+    Returns:
+        sqlite3.Connection: The connection, with transactions opened explicitly per page.
+    """
+    conn = sqlite3.connect(database_location, isolation_level="DEFERRED")
     c = conn.cursor()
+    # WAL journal and relaxed syncing keep commits cheap and let readers run alongside
+    c.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-65536;
+        PRAGMA mmap_size=268435456;
+    """)
     # Create table
     c.execute("""
         CREATE TABLE IF NOT EXISTS issues (
@@ -163,13 +205,173 @@ def update(database_location, days, project, email, token, health_check_url=None
             md5_hash TEXT
         )
     """)
-    try:
+    # Issue keys are unique, this index serves the per-page probe and the upsert.
+    # On an empty table it is built after the first full load instead, in one pass
+    if c.execute("SELECT 1 FROM issues LIMIT 1").fetchone() is not None:
+        c.execute(CREATE_INDEX_SQL)
+    return conn
+
+
+def get_connection(database_location):
+    """
+    Returns the open database connection, opening it on the first call.
+
+    Scheduled runs reuse it instead of reopening the file and re-running the setup
+    statements.
+
+    Args:
+        database_location (str): The location of the SQLite database.
+
+    Returns:
+        sqlite3.Connection: The shared connection.
+    """
+    global _CONN
+    if _CONN is None:
+        _CONN = connect_database(database_location)
+    return _CONN
+
+
+def close_connection():
+    """
+    Closes the shared database connection, if it is open.
+    """
+    global _CONN
+    if _CONN is not None:
+        _CONN.close()
+        _CONN = None
+
+
+def update(database_location, days, project, email, token, health_check_url=None):
+    """
+    Updates the database with issues from JIRA based on the given parameters.
+
+    Args:
+        database_location (str): The location of the SQLite database.
+        days (int): The number of days back from today to fetch updated issues.
+        project (str): The project key to filter the issues.
+        email (str): The JIRA email.
+        token (str): The JIRA token.
+
+    Raises:
+        ValueError: If the JIRA email or token is not provided.
+
+    Returns:
+        None
+
+    """
+    if email is None or token is None:
+        raise ValueError("Jira email and token are required")
+    logging.info(f"Health check: {HEALTH_CHECK_URL}")
+    # bsup = jira.project(project)
+
+    # Define JQL query to fetch issues updated within the last n days, using Jira's
+    # relative date syntax so the query text is the same on every scheduled run
+    jql_query = f"project={project} AND updated >= -{days}d"
+    # jql_query = f"project={project}"
+
+    # Define fields to retrieve, only those stored in the database are requested
+    fields = [
+        "summary",
+        "assignee",
+        "created",
+        "creator",
+        "description",
+        "duedate",
+        "environment",
+        "issuetype",
+        "labels",
+        "lastViewed",
+        "priority",
+        "project",
+        "reporter",
+        "resolution",
+        "resolutiondate",
+        "status",
+        "updated",
+        "timeoriginalestimate",
+        "aggregatetimeestimate",
+        "worklog",
+        "timetracking",
+        "customfield_10065",
+    ]
+
+    # The enhanced search returns up to 5000 issues per page when fields are limited
+    max_results = 5000
+    logging.info("Starting...")
+
+    def fetch_pages():
+        """
+        Yields pages of raw issue JSON, following the search's nextPageToken.
+        """
+        params = {
+            "jql": jql_query,
+            "fields": ",".join(fields),
+            "maxResults": max_results,
+        }
+        fetched = 0
         while True:
-            print(f"Fetching issues from {start_at} to {start_at + max_results}")
-            issues = jira.search_issues(
-                jql_query, startAt=start_at, maxResults=max_results
-            )
+            print(f"Fetching issues from {fetched} to {fetched + max_results}")
+            # Raw JSON avoids building an Issue object for every field of every issue
+            page = jira._session.get(
+                f"{JIRA_SERVER}/rest/api/2/search/jql", params=params
+            ).json()
+            yield page["issues"]
+            fetched += len(page["issues"])
+            if page.get("isLast") or "nextPageToken" not in page:
+                break
+            params["nextPageToken"] = page["nextPageToken"]
 
+    conn = None
+    try:
+        # Reuse the SQLite connection opened by an earlier run
+        conn = get_connection(database_location)
+        c = conn.cursor()
+        jira = JIRA(
+            server=JIRA_SERVER,
+            basic_auth=(email, token),
+            timeout=JIRA_API_REQUEST_TIMEOUT,
+            # Retries are handled by the adapter below, which is mounted before the
+            # first request is sent, so skip the server info request made on creation
+            max_retries=0,
+            get_server_info=False,
+        )
+        # Reuse the same connection for every page, and retry transient failures with
+        # backoff so a single 5xx or rate-limited page does not abort the whole run
+        retry = Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("GET",),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=retry)
+        jira._session.mount("https://", adapter)
+        jira._session.headers["Connection"] = "keep-alive"
+        # Once the issue_key index exists every changed issue is upserted, the first
+        # load of an empty database inserts and builds the index at the end instead
+        indexed = (
+            c.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_issues_issue_key'"
+            ).fetchone()
+            is not None
+        )
+        for issues in fetch_pages():
+            # Write the whole page in a single transaction
+            conn.execute("BEGIN")
+            # Look up the stored hashes of this page's issues, a chunk of keys per
+            # query to stay under the bound variable limit of older SQLite builds
+            keys = [issue["key"] for issue in issues]
+            existing = {}
+            for i in range(0, len(keys), PROBE_CHUNK_SIZE):
+                chunk = keys[i : i + PROBE_CHUNK_SIZE]
+                c.execute(
+                    f"SELECT issue_key, md5_hash FROM issues WHERE issue_key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+                existing.update(c.fetchall())
+            upserts = []
+            inserts = []
+            updates = []
             # Print fetched data
             for issue in issues:
                 # print("Assignee:", issue.fields.assignee.displayName if issue.fields.assignee else None)
@@ -201,72 +403,64 @@ def update(database_location, days, project, email, token, health_check_url=None
                 # print(f"Participants: {issue.fields.customfield_10035}")
                 # print("==="*20)
 
+                key = issue["key"]
+                f = issue["fields"]
+
                 # Prepare data
+                worklogs = f["worklog"]["worklogs"]
                 data = (
-                    issue.fields.assignee.displayName
-                    if issue.fields.assignee
-                    else None,
-                    issue.fields.assignee.accountId if issue.fields.assignee else None,
-                    issue.fields.created,
-                    issue.fields.creator.displayName if issue.fields.creator else None,
-                    issue.fields.description,
-                    issue.fields.duedate,
-                    issue.fields.environment,
-                    issue.fields.issuetype.name,
-                    issue.key,
-                    issue.fields.issuetype.id,
-                    ", ".join(issue.fields.labels),
-                    issue.fields.lastViewed,
-                    issue.fields.priority.name,
-                    issue.fields.project.key,
-                    issue.fields.reporter.displayName
-                    if issue.fields.reporter
-                    else None,
-                    issue.fields.resolution.name if issue.fields.resolution else None,
-                    issue.fields.resolutiondate,
-                    issue.fields.status.name,
-                    issue.fields.summary,
-                    issue.fields.updated,
-                    issue.fields.timeoriginalestimate,
-                    issue.fields.aggregatetimeestimate,
+                    f["assignee"]["displayName"] if f["assignee"] else None,
+                    f["assignee"]["accountId"] if f["assignee"] else None,
+                    f["created"],
+                    f["creator"]["displayName"] if f["creator"] else None,
+                    f["description"],
+                    f["duedate"],
+                    f["environment"],
+                    f["issuetype"]["name"],
+                    key,
+                    f["issuetype"]["id"],
+                    ", ".join(f["labels"]),
+                    f.get("lastViewed"),
+                    f["priority"]["name"],
+                    f["project"]["key"],
+                    f["reporter"]["displayName"] if f["reporter"] else None,
+                    f["resolution"]["name"] if f["resolution"] else None,
+                    f["resolutiondate"],
+                    f["status"]["name"],
+                    f["summary"],
+                    f["updated"],
+                    f["timeoriginalestimate"],
+                    f["aggregatetimeestimate"],
                     ", ".join(
-                        [
-                            f"{x.timeSpent}|started:({(x.started)})"
-                            for x in issue.fields.worklog.worklogs
-                            if len(issue.fields.worklog.worklogs) > 0
-                        ]
+                        f"{x['timeSpent']}|started:({x['started']})" for x in worklogs
                     ),
-                    issue.fields.timetracking.raw.get("timeSpent", None)
-                    if issue.fields.timetracking.raw
-                    else None,
-                    str(issue.fields.customfield_10065),
+                    f["timetracking"].get("timeSpent") if f["timetracking"] else None,
+                    _readable(f.get("customfield_10065")),
                 )
-                num_columns = len(data) + 1  # Add 1 for md5_hash
-                placeholders = ["?"] * num_columns
-                # Calculate md5 hash of the data
-                md5_hash = calculate_md5(*data)
-                # Check if a record with the same hash already exists
-                c.execute("SELECT * FROM issues WHERE md5_hash = ? ", (md5_hash,))
-                if c.fetchone() is None:
-                    c.execute("SELECT * FROM issues WHERE issue_key = ? ", (issue.key,))
-                    if c.fetchone() is None:
-                        logging.info(f"Inserting issue: {issue.key}")
-                        # Insert data into database
-                        c.execute(
-                            f"""INSERT INTO issues VALUES
-                        ({",".join(placeholders)})""",
-                            data + (md5_hash,),
-                        )
-                    else:
-                        logging.info(f"Updating issue: {issue.key}")
-                        c.execute(
-                            """
-                                UPDATE issues
-                                SET assignee = ?, assignee_id = ?,created = ?, creator = ?, description = ?, due_date = ?, environment = ?, issue_type = ?, issue_key = ?, issue_id = ?, labels = ?, last_viewed = ?, priority = ?, project = ?, reporter = ?, resolution = ?, resolution_date = ?, status = ?, summary = ?, updated = ?, original_estimate = ?, remaining_estimate = ?, worklog = ?, time_tracking = ?, isp = ?, md5_hash = ?
-                                WHERE issue_key = ?
-                            """,
-                            data + (md5_hash, issue.key),
-                        )
+                # Calculate the hash of the data
+                row_hash = calculate_hash(data)
+                # Skip issues whose stored record has the same hash
+                if existing.get(key) == row_hash:
+                    continue
+                # Changed rows are written in batches below
+                if indexed:
+                    logging.info(f"Upserting issue: {key}")
+                    upserts.append(data + (row_hash,))
+                elif key in existing:
+                    logging.info(f"Updating issue: {key}")
+                    updates.append(data + (row_hash, key))
+                else:
+                    logging.info(f"Inserting issue: {key}")
+                    inserts.append(data + (row_hash,))
+                existing[key] = row_hash
+            # Upsert changed issues, or on a first load insert new ones and update
+            # those already written by an earlier page in place
+            if indexed:
+                c.executemany(UPSERT_SQL, upserts)
+            else:
+                c.executemany(INSERT_SQL, inserts)
+                c.executemany(UPDATE_SQL, updates)
+            conn.commit()
 
             # Find custom fields
             # fields = jira.fields()
@@ -277,16 +471,15 @@ def update(database_location, days, project, email, token, health_check_url=None
             #     if "participants" in k.lower():
             #         print(f"{k}:{v}")
 
-            if len(issues) < max_results:
-                break
-            start_at += max_results
-
-        # Commit changes and close connection
-        conn.commit()
-        conn.close()
+        # Build the index deferred by the first load
+        if not indexed:
+            c.execute(CREATE_INDEX_SQL)
         logging.info("Completed!")
         health_check(HEALTH_CHECK_URL)
     except Exception as e:
+        # Discard the partially written page, earlier pages are already committed
+        if conn is not None:
+            conn.rollback()
         logging.error(e)
 
 
@@ -357,19 +550,29 @@ def main():
             token=args.token,
             health_check_url=HEALTH_CHECK_URL,
         )
+        # Sleep until the next job is due instead of spinning on run_pending()
         while True:
+            n = schedule.idle_seconds()
+            if n is None:
+                break
+            if n > 0:
+                time.sleep(n)
             schedule.run_pending()
     else:
         logging.info(f"Running the script for {args.days} days")
         # Call the update function with the parsed arguments
-        update(
-            args.database,
-            args.days,
-            args.project,
-            args.email,
-            args.token,
-            HEALTH_CHECK_URL,
-        )
+        try:
+            update(
+                args.database,
+                args.days,
+                args.project,
+                args.email,
+                args.token,
+                HEALTH_CHECK_URL,
+            )
+        finally:
+            # Closing lets SQLite checkpoint and remove the WAL files
+            close_connection()
 
 
 if __name__ == "__main__":
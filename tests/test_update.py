@@ -0,0 +1,235 @@
+import importlib.util
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "qib_jira", Path(__file__).parent.parent / "qib-jira.py"
+)
+qib_jira = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(qib_jira)
+
+
+def make_issue(key, updated="2024-01-01T00:00:00.000+0000", **fields):
+    """
+    Builds the raw JSON of an issue as returned by the search endpoint.
+    """
+    raw = {
+        "assignee": {"displayName": "Alice", "accountId": "a1"},
+        "created": "2024-01-01T00:00:00.000+0000",
+        "creator": {"displayName": "Bob"},
+        "description": "A description",
+        "duedate": None,
+        "environment": None,
+        "issuetype": {"name": "Task", "id": "10001"},
+        "labels": ["bioinf"],
+        "lastViewed": None,
+        "priority": {"name": "Medium"},
+        "project": {"key": "BSUP"},
+        "reporter": {"displayName": "Bob"},
+        "resolution": None,
+        "resolutiondate": None,
+        "status": {"name": "Open"},
+        "summary": f"Summary of {key}",
+        "updated": updated,
+        "timeoriginalestimate": None,
+        "aggregatetimeestimate": 3600,
+        "worklog": {"worklogs": [{"timeSpent": "1h", "started": "2024-01-01"}]},
+        "timetracking": {"timeSpent": "1h"},
+        "customfield_10065": {"value": "ISP 1"},
+    }
+    raw.update(fields)
+    return {"key": key, "fields": raw}
+
+
+class FakeResponse:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+class FakeSession:
+    """
+    Serves the given pages of issues, chained with nextPageToken.
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.headers = {}
+        self.adapters = {}
+        self.requests = []
+
+    def mount(self, prefix, adapter):
+        self.adapters[prefix] = adapter
+
+    def get(self, url, params=None):
+        self.requests.append((url, dict(params)))
+        index = int(params.get("nextPageToken", 0))
+        payload = {"issues": self.pages[index]}
+        if index + 1 < len(self.pages):
+            payload["nextPageToken"] = str(index + 1)
+        else:
+            payload["isLast"] = True
+        return FakeResponse(payload)
+
+
+@pytest.fixture
+def database(tmp_path):
+    yield str(tmp_path / "issues.db")
+    qib_jira.close_connection()
+
+
+@pytest.fixture
+def run(monkeypatch, database):
+    """
+    Runs update() against the database with a stubbed Jira client, and returns it.
+    """
+    monkeypatch.setattr(qib_jira, "HEALTH_CHECK_URL", None)
+    monkeypatch.setattr(qib_jira, "health_check", lambda url: None)
+
+    def run(*pages):
+        clients = []
+
+        class FakeJIRA:
+            def __init__(self, **kwargs):
+                self.kwargs = kwargs
+                self._session = FakeSession(list(pages))
+                clients.append(self)
+
+        monkeypatch.setattr(qib_jira, "JIRA", FakeJIRA)
+        qib_jira.update(database, 30, "BSUP", "email", "token")
+        return clients[0]
+
+    return run
+
+
+def rows(database):
+    with sqlite3.connect(database) as conn:
+        return {
+            key: (estimate, viewed, md5)
+            for key, estimate, viewed, md5 in conn.execute(
+                "SELECT issue_key, remaining_estimate, last_viewed, md5_hash FROM issues"
+            )
+        }
+
+
+def test_later_runs_upsert_new_and_changed_issues(run, database):
+    run([make_issue("BSUP-1")])
+
+    run([make_issue("BSUP-1", summary="Changed"), make_issue("BSUP-2")])
+
+    with sqlite3.connect(database) as conn:
+        assert conn.execute(
+            "SELECT issue_key, summary FROM issues ORDER BY issue_key"
+        ).fetchall() == [("BSUP-1", "Changed"), ("BSUP-2", "Summary of BSUP-2")]
+
+
+def test_changes_without_updated_bump_are_written(run, database):
+    run([make_issue("BSUP-1")])
+    _, _, old_hash = rows(database)["BSUP-1"]
+
+    # Same updated timestamp, but work was logged on a sub-task and the issue viewed
+    run(
+        [
+            make_issue(
+                "BSUP-1",
+                aggregatetimeestimate=1800,
+                lastViewed="2024-02-01T00:00:00.000+0000",
+            )
+        ]
+    )
+
+    estimate, viewed, new_hash = rows(database)["BSUP-1"]
+    assert estimate == "1800"
+    assert viewed == "2024-02-01T00:00:00.000+0000"
+    assert new_hash != old_hash
+
+
+def test_search_pages_through_the_stored_fields(run):
+    jira = run([make_issue("BSUP-1")], [make_issue("BSUP-2")])
+
+    (url, params), (next_url, next_params) = jira._session.requests
+    assert url == next_url == f"{qib_jira.JIRA_SERVER}/rest/api/2/search/jql"
+    assert set(params["fields"].split(",")) == set(make_issue("BSUP-1")["fields"])
+    assert params["maxResults"] == 5000
+    assert "nextPageToken" not in params
+    assert next_params["nextPageToken"] == "1"
+
+
+def test_probe_stays_under_the_bound_variable_limit(run, database):
+    conn = qib_jira.get_connection(database)
+    conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+
+    run([make_issue(f"BSUP-{i}") for i in range(1000)])
+
+    assert len(rows(database)) == 1000
+
+
+def test_unchanged_issue_is_not_rewritten(run, database):
+    run([make_issue("BSUP-1")])
+    with sqlite3.connect(database) as conn:
+        conn.executescript("""
+            CREATE TABLE writes (issue_key TEXT);
+            CREATE TRIGGER count_updates AFTER UPDATE ON issues
+            BEGIN INSERT INTO writes VALUES (new.issue_key); END;
+        """)
+
+    run([make_issue("BSUP-1")])
+
+    with sqlite3.connect(database) as conn:
+        assert conn.execute("SELECT * FROM writes").fetchall() == []
+
+
+def test_search_uses_a_relative_jql_date(run):
+    jira = run([make_issue("BSUP-1")])
+
+    [(_, params)] = jira._session.requests
+    assert params["jql"] == "project=BSUP AND updated >= -30d"
+
+
+def test_client_retries_transient_failures(run):
+    jira = run([make_issue("BSUP-1")])
+
+    assert jira.kwargs["timeout"] == qib_jira.JIRA_API_REQUEST_TIMEOUT
+    # Retries are left to the mounted adapter, which also covers the first request
+    assert jira.kwargs["max_retries"] == 0
+    assert jira.kwargs["get_server_info"] is False
+    retry = jira._session.adapters["https://"].max_retries
+    assert retry.total == 5
+    assert retry.backoff_factor == 0.5
+    assert set(retry.status_forcelist) == {429, 500, 502, 503, 504}
+    assert set(retry.allowed_methods) == {"GET"}
+    assert retry.raise_on_status is False
+
+
+def has_index(database):
+    with sqlite3.connect(database) as conn:
+        return (
+            conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'idx_issues_issue_key'"
+            ).fetchone()
+            is not None
+        )
+
+
+def test_first_load_inserts_and_builds_index(run, database):
+    qib_jira.get_connection(database)
+    assert not has_index(database)
+
+    run([make_issue("BSUP-1"), make_issue("BSUP-2")])
+
+    assert set(rows(database)) == {"BSUP-1", "BSUP-2"}
+    assert has_index(database)
+
+
+def test_first_load_with_key_repeated_on_later_page(run, database):
+    run([make_issue("BSUP-1")], [make_issue("BSUP-1", summary="Changed")])
+
+    with sqlite3.connect(database) as conn:
+        assert conn.execute("SELECT issue_key, summary FROM issues").fetchall() == [
+            ("BSUP-1", "Changed")
+        ]
+    assert has_index(database)